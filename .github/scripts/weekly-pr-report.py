@@ -6,35 +6,141 @@
 - 기간: 지난 금요일 16:00 KST ~ 이번 금요일 16:00 KST
 """
 
+import hashlib
+import http.client
 import json
 import os
+import string
 import sys
-import urllib.request
-from collections import defaultdict
+import threading
+import time
+import urllib.parse
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 
+try:
+    import orjson
+except ImportError:  # 미설치 환경에서는 표준 json 사용
+    orjson = None
+
 GRAPHQL_URL = "https://api.github.com/graphql"
+SLACK_POST_URL = "https://slack.com/api/chat.postMessage"
 KST = timezone(timedelta(hours=9))
 REPORT_HOUR = 16  # 매주 금요일 16시 발행
+CACHE_DIR = os.path.expanduser("~/.cache/weekly-pr-report")
+MAX_RETRIES = 3
+RETRY_STATUS = {429, 500, 502, 503, 504}
+RATE_LIMIT_MIN_REMAINING = 200  # 남은 포인트가 이보다 적으면 리셋까지 대기 (최대 60초)
+
+_local = threading.local()
+
+
+def dumps(obj):
+    """JSON 직렬화 (공백 없는 UTF-8 bytes)"""
+    if orjson:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def loads(data):
+    """JSON 역직렬화"""
+    return orjson.loads(data) if orjson else json.loads(data)
+
 
+def _connection(host):
+    """호스트별 keep-alive 연결 (스레드마다 하나씩 재사용)"""
+    if not hasattr(_local, "conns"):
+        _local.conns = {}
+    conn = _local.conns.get(host)
+    if conn is None:
+        conn = _local.conns[host] = http.client.HTTPSConnection(host, timeout=30)
+    return conn
 
-def graphql(query, variables=None):
-    """GitHub GraphQL API 호출"""
+
+def _retry_after(resp):
+    """429 응답의 Retry-After(초) 값, 없거나 형식이 다르면 None"""
+    try:
+        return max(0.0, float(resp.getheader("Retry-After")))
+    except (TypeError, ValueError):
+        return None
+
+
+def post_json(url, payload, token, idempotent=True):
+    """JSON POST 요청 (연결 재사용, 일시적 오류는 지수 백오프로 재시도, bytes는 그대로 전송)
+
+    idempotent=False(Slack 메시지 전송 등)면 요청이 나가기 전 연결 실패와
+    429만 재시도해서 이미 처리된 요청이 중복 전송되지 않게 함
+    """
+    parts = urllib.parse.urlsplit(url)
+    body = payload if isinstance(payload, bytes) else dumps(payload)
+    headers = {
+        "Authorization": f"Bearer {token}",
+        "Content-Type": "application/json",
+        "User-Agent": "weekly-pr-report",
+    }
+    for attempt in range(MAX_RETRIES + 1):
+        # 지수 백오프: 1s, 2s, 4s (429는 Retry-After 우선)
+        delay = 2 ** attempt
+        conn = _connection(parts.netloc)
+        try:
+            if conn.sock is None:
+                conn.connect()
+        except OSError:
+            # 아직 아무것도 보내지 않았으므로 항상 재시도 가능
+            conn.close()
+            if attempt == MAX_RETRIES:
+                raise
+            time.sleep(delay)
+            continue
+        try:
+            conn.request("POST", parts.path, body=body, headers=headers)
+            resp = conn.getresponse()
+            data = resp.read()
+        except (http.client.HTTPException, OSError):
+            # 끊긴 연결은 닫아두면 다음 요청에서 다시 연결됨
+            conn.close()
+            if not idempotent or attempt == MAX_RETRIES:
+                raise
+        else:
+            if resp.status < 400:
+                return loads(data)
+            retryable = resp.status == 429 or (idempotent and resp.status in RETRY_STATUS)
+            if not retryable or attempt == MAX_RETRIES:
+                print(f"HTTP {resp.status} ({url}): {data.decode(errors='replace')}", file=sys.stderr)
+                sys.exit(1)
+            if resp.status == 429:
+                delay = _retry_after(resp) or delay
+        time.sleep(delay)
+
+
+def compact_query(query):
+    """쿼리 공백 압축 (GitHub는 persisted query 미지원이라 매 요청 본문에 쿼리 전문이 실림)"""
+    return " ".join(query.split())
+
+
+def graphql(query, variables=None, allow_not_found=False):
+    """GitHub GraphQL API 호출 (allow_not_found면 사라진 노드의 NOT_FOUND 오류는 무시, 해당 노드는 null)"""
     token = os.environ["GH_TOKEN"]
-    body = json.dumps({"query": query, "variables": variables or {}}).encode()
-    req = urllib.request.Request(
-        GRAPHQL_URL,
-        data=body,
-        headers={
-            "Authorization": f"Bearer {token}",
-            "Content-Type": "application/json",
-        },
-    )
-    with urllib.request.urlopen(req) as resp:
-        data = json.loads(resp.read())
-    if "errors" in data:
-        print(f"GraphQL errors: {json.dumps(data['errors'], indent=2)}", file=sys.stderr)
+    data = post_json(GRAPHQL_URL, {"query": query, "variables": variables or {}}, token)
+    errors = data.get("errors")
+    if errors and allow_not_found:
+        not_found = [e for e in errors if e.get("type") == "NOT_FOUND"]
+        if not_found:
+            print(f"Warning: 조회 중 사라졌거나 접근할 수 없는 노드 {len(not_found)}개 제외\n", end="", file=sys.stderr)
+        errors = [e for e in errors if e.get("type") != "NOT_FOUND"]
+    if errors:
+        print(f"GraphQL errors: {json.dumps(errors, indent=2)}", file=sys.stderr)
         sys.exit(1)
+    rate = data["data"].get("rateLimit")
+    if rate:
+        # 리뷰 상세 조회 스레드와 출력이 섞이지 않도록 한 번에 씀
+        print(f"    GraphQL cost {rate['cost']}, 남은 한도 {rate['remaining']}\n", end="")
+        if rate["remaining"] < RATE_LIMIT_MIN_REMAINING:
+            reset_at = datetime.fromisoformat(rate["resetAt"].replace("Z", "+00:00"))
+            wait = min(60, max(0, (reset_at - datetime.now(timezone.utc)).total_seconds()))
+            print(f"Warning: GraphQL 한도 부족, {wait:.0f}초 대기", file=sys.stderr)
+            time.sleep(wait)
     return data["data"]
 
 
@@ -54,127 +160,190 @@ def to_github_date(dt):
     return dt.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
 
 
-def search_prs_created(org, since, until):
-    """이번 주 생성된 PR 조회"""
-    query = """
-    query($q: String!, $cursor: String) {
-      search(query: $q, type: ISSUE, first: 100, after: $cursor) {
-        issueCount
-        pageInfo { hasNextPage endCursor }
-        nodes {
-          ... on PullRequest {
-            number
-            author { login }
-            repository { name }
-          }
-        }
+# alias 두 개를 한 문서로 묶어 페이지마다 한 번만 왕복하고,
+# 먼저 끝난 쪽은 @include로 빼서 남은 쪽만 계속 페이지네이션.
+# updated 쪽은 마지막 리뷰 시각만 받아서 걸러내고, 리뷰 상세는 REVIEWS_QUERY로 따로 조회
+SEARCH_QUERY = compact_query("""
+query(
+  $createdQ: String!, $createdCursor: String, $createdInclude: Boolean!,
+  $updatedQ: String!, $updatedCursor: String, $updatedInclude: Boolean!
+) {
+  created: search(query: $createdQ, type: ISSUE, first: 100, after: $createdCursor)
+    @include(if: $createdInclude) {
+    pageInfo { hasNextPage endCursor }
+    nodes {
+      ... on PullRequest {
+        author { login }
+        repository { name }
       }
     }
-    """
-    search_q = f"org:{org} type:pr created:{to_github_date(since)}..{to_github_date(until)}"
-    return _paginate_search(query, search_q)
-
-
-def search_prs_with_reviews(org, since, until):
-    """이번 주 업데이트된 PR에서 리뷰 코멘트 조회"""
-    query = """
-    query($q: String!, $cursor: String) {
-      search(query: $q, type: ISSUE, first: 100, after: $cursor) {
-        issueCount
-        pageInfo { hasNextPage endCursor }
+  }
+  updated: search(query: $updatedQ, type: ISSUE, first: 100, after: $updatedCursor)
+    @include(if: $updatedInclude) {
+    pageInfo { hasNextPage endCursor }
+    nodes {
+      ... on PullRequest {
+        id
+        reviews(last: 1) { nodes { createdAt } }
+      }
+    }
+  }
+  rateLimit { cost remaining resetAt }
+}
+""")
+
+REVIEWS_QUERY = compact_query("""
+query($ids: [ID!]!) {
+  nodes(ids: $ids) {
+    ... on PullRequest {
+      repository { name }
+      reviews(last: 100) {
         nodes {
-          ... on PullRequest {
-            number
-            repository { name }
-            reviews(last: 100) {
-              nodes {
-                author { login }
-                createdAt
-                comments { totalCount }
-              }
-            }
-          }
+          author { login }
+          createdAt
+          comments { totalCount }
         }
       }
     }
-    """
-    search_q = f"org:{org} type:pr updated:{to_github_date(since)}..{to_github_date(until)}"
-    return _paginate_search(query, search_q)
-
-
-def _paginate_search(query, search_q):
-    """Search API 페이지네이션"""
-    cursor = None
-    results = []
-    while True:
-        data = graphql(query, {"q": search_q, "cursor": cursor})
-        search = data["search"]
-        results.extend([n for n in search["nodes"] if n])
-        if not search["pageInfo"]["hasNextPage"]:
-            break
-        cursor = search["pageInfo"]["endCursor"]
-        if len(results) >= 1000:
-            print("Warning: 검색 결과 1000개 초과, 일부 누락 가능", file=sys.stderr)
-            break
-    return results
-
-
-def aggregate(created_prs, updated_prs, since, until):
-    """통계 집계"""
-    pr_by_repo = defaultdict(int)
-    pr_by_person = defaultdict(int)
-    comments_by_repo = defaultdict(int)
-    comments_by_person = defaultdict(int)
+  }
+  rateLimit { cost remaining resetAt }
+}
+""")
+
+
+def search_prs(org, since_iso, until_iso):
+    """이번 주 생성된 PR + 이번 주 리뷰가 달린 PR(리뷰 코멘트) 조회"""
+    date_range = f"{since_iso}..{until_iso}"
+    search_qs = {
+        "created": f"org:{org} type:pr created:{date_range}",
+        "updated": f"org:{org} type:pr updated:{date_range}",
+    }
+    created_prs = []
+    review_batches = []
+    # 리뷰 상세 조회는 페이지가 도착하는 대로 백그라운드에서 실행해 다음 페이지 조회와 겹침
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        for alias, nodes in _paginate_search(SEARCH_QUERY, search_qs):
+            if alias == "created":
+                created_prs.extend(nodes)
+                continue
+            # 마지막 리뷰가 기간 시작 전이면 기간 내 리뷰도 없음.
+            # 검색 이후 삭제/비공개된 PR은 nodes 결과에서 null로 오므로 아래에서 제외
+            ids = [
+                pr["id"] for pr in nodes
+                if pr["reviews"]["nodes"] and pr["reviews"]["nodes"][0]["createdAt"] >= since_iso
+            ]
+            if ids:
+                review_batches.append(executor.submit(graphql, REVIEWS_QUERY, {"ids": ids}, allow_not_found=True))
+        updated_prs = [pr for batch in review_batches for pr in batch.result()["nodes"] if pr]
+    return created_prs, updated_prs
+
+
+def _paginate_search(query, search_qs):
+    """Search API 페이지네이션 (alias별 커서 관리, 페이지가 도착하는 대로 (alias, nodes) 반환)"""
+    cursors = {alias: None for alias in search_qs}
+    counts = {alias: 0 for alias in search_qs}
+    pending = set(search_qs)
+    while pending:
+        variables = {}
+        for alias, search_q in search_qs.items():
+            variables[f"{alias}Q"] = search_q
+            variables[f"{alias}Cursor"] = cursors[alias]
+            variables[f"{alias}Include"] = alias in pending
+        data = graphql(query, variables)
+        for alias in list(pending):
+            search = data[alias]
+            nodes = [n for n in search["nodes"] if n]
+            counts[alias] += len(nodes)
+            yield alias, nodes
+            if not search["pageInfo"]["hasNextPage"]:
+                pending.discard(alias)
+                continue
+            cursors[alias] = search["pageInfo"]["endCursor"]
+            if counts[alias] >= 1000:
+                print(f"Warning: {alias} 검색 결과 1000개 초과, 일부 누락 가능", file=sys.stderr)
+                pending.discard(alias)
 
+
+def aggregate(created_prs, updated_prs, since_iso, until_iso):
+    """통계 집계"""
     # PR 생성 통계
-    for pr in created_prs:
-        repo = pr["repository"]["name"]
-        author = pr["author"]["login"] if pr.get("author") else "ghost"
-        pr_by_repo[repo] += 1
-        pr_by_person[author] += 1
+    pr_by_repo = Counter(pr["repository"]["name"] for pr in created_prs)
+    pr_by_person = Counter(pr["author"]["login"] if pr.get("author") else "ghost" for pr in created_prs)
 
     # 리뷰 코멘트 통계 (이번 주 기간 내에 작성된 리뷰만)
-    since_str = to_github_date(since)
-    until_str = to_github_date(until)
+    # createdAt은 항상 UTC 고정 형식(YYYY-MM-DDTHH:MM:SSZ)이라 문자열 비교 = 시간 비교
+    comments_by_repo = Counter()
+    comments_by_person = Counter()
     for pr in updated_prs:
         repo = pr["repository"]["name"]
-        for review in pr.get("reviews", {}).get("nodes", []):
-            created_at = review.get("createdAt", "")
-            if not (since_str <= created_at <= until_str):
+        for review in pr["reviews"]["nodes"]:
+            if not (since_iso <= review["createdAt"] <= until_iso):
                 continue
-            reviewer = review["author"]["login"] if review.get("author") else "ghost"
+            author = review["author"]
             count = review["comments"]["totalCount"]
             comments_by_repo[repo] += count
-            comments_by_person[reviewer] += count
+            comments_by_person[author["login"] if author else "ghost"] += count
 
-    desc = lambda d: dict(sorted(d.items(), key=lambda x: -x[1]))
     return {
         "total_prs": sum(pr_by_repo.values()),
         "total_comments": sum(comments_by_repo.values()),
-        "pr_by_repo": desc(pr_by_repo),
-        "pr_by_person": desc(pr_by_person),
-        "comments_by_repo": desc(comments_by_repo),
-        "comments_by_person": desc(comments_by_person),
+        "pr_by_repo": pr_by_repo,
+        "pr_by_person": pr_by_person,
+        "comments_by_repo": comments_by_repo,
+        "comments_by_person": comments_by_person,
     }
 
 
+def _cache_path(org, since, until):
+    """집계 캐시 파일 경로 (org별 디렉터리 아래 기간별 파일)"""
+    key = hashlib.sha256(f"{org}|{since.isoformat()}|{until.isoformat()}".encode()).hexdigest()
+    return os.path.join(CACHE_DIR, org, f"{key}.json")
+
+
+def load_cached_stats(org, since, until):
+    """같은 기간의 집계 결과가 있으면 반환 (재실행 시 GitHub 조회 생략)"""
+    try:
+        with open(_cache_path(org, since, until), "rb") as f:
+            stats = loads(f.read())
+    except (OSError, ValueError):
+        return None
+    for key in ("pr_by_repo", "pr_by_person", "comments_by_repo", "comments_by_person"):
+        stats[key] = Counter(stats[key])
+    return stats
+
+
+def save_cached_stats(org, since, until, stats):
+    """집계 결과 저장 (기간이 끝난 뒤에만 저장해서 주중 수동 실행 결과가 남지 않게 함)"""
+    if datetime.now(KST) < until:
+        return
+    path = _cache_path(org, since, until)
+    org_dir = os.path.dirname(path)
+    os.makedirs(org_dir, exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(dumps(stats))
+    # 재실행에는 이번 기간 결과만 필요하므로 같은 org의 지난 기간 파일은 정리
+    # (self-hosted 러너에서는 디렉터리가 계속 유지되어 actions/cache 업로드도 같이 커짐).
+    # 다른 org의 캐시는 별도 디렉터리라 건드리지 않음
+    for name in os.listdir(org_dir):
+        other = os.path.join(org_dir, name)
+        if other != path and name.endswith(".json"):
+            os.remove(other)
+
+
 def ranking(data, unit="건", limit=10):
-    """순위 텍스트 포맷"""
-    items = list(data.items())[:limit]
+    """순위 텍스트 포맷 (상위 limit개만 부분 정렬)"""
+    items = data.most_common(limit)
     if not items:
         return "활동 없음"
     return "\n".join(f"{i}. {name}: {count}{unit}" for i, (name, count) in enumerate(items, 1))
 
 
-def send_slack(stats, since, until):
-    """Slack Bot Token으로 메시지 전송"""
-    token = os.environ["SLACK_BOT_TOKEN"]
-    channel = os.environ["SLACK_CHANNEL_ID"]
-
-    since_str = since.astimezone(KST).strftime("%m/%d %H:%M")
-    until_str = until.astimezone(KST).strftime("%m/%d %H:%M")
-
-    blocks = [
+# 레이아웃은 고정이라 payload JSON을 미리 만들어두고 값만 채움
+# (JSON 중괄호와 겹치지 않도록 str.format 대신 string.Template의 ${...} 사용)
+SLACK_TEMPLATE = string.Template(json.dumps({
+    "channel": "${channel}",
+    "text": "주간 PR 리포트 ${since} ~ ${until}",
+    "blocks": [
         {
             "type": "header",
             "text": {"type": "plain_text", "text": "📊 주간 PR 리포트", "emoji": True},
@@ -182,62 +351,59 @@ def send_slack(stats, since, until):
         {
             "type": "section",
             "fields": [
-                {"type": "mrkdwn", "text": f"*총 PR:*\n{stats['total_prs']}건"},
-                {"type": "mrkdwn", "text": f"*총 리뷰 코멘트:*\n{stats['total_comments']}건"},
+                {"type": "mrkdwn", "text": "*총 PR:*\n${total_prs}건"},
+                {"type": "mrkdwn", "text": "*총 리뷰 코멘트:*\n${total_comments}건"},
             ],
         },
         {"type": "divider"},
         {
             "type": "section",
-            "text": {
-                "type": "mrkdwn",
-                "text": f"*📁 레포별 PR*\n```\n{ranking(stats['pr_by_repo'])}```",
-            },
+            "text": {"type": "mrkdwn", "text": "*📁 레포별 PR*\n```\n${pr_by_repo}```"},
         },
         {
             "type": "section",
-            "text": {
-                "type": "mrkdwn",
-                "text": f"*👤 사람별 PR*\n```\n{ranking(stats['pr_by_person'])}```",
-            },
+            "text": {"type": "mrkdwn", "text": "*👤 사람별 PR*\n```\n${pr_by_person}```"},
         },
         {"type": "divider"},
         {
             "type": "section",
-            "text": {
-                "type": "mrkdwn",
-                "text": f"*📁 레포별 리뷰 코멘트*\n```\n{ranking(stats['comments_by_repo'])}```",
-            },
+            "text": {"type": "mrkdwn", "text": "*📁 레포별 리뷰 코멘트*\n```\n${comments_by_repo}```"},
         },
         {
             "type": "section",
-            "text": {
-                "type": "mrkdwn",
-                "text": f"*👤 사람별 리뷰 코멘트*\n```\n{ranking(stats['comments_by_person'])}```",
-            },
+            "text": {"type": "mrkdwn", "text": "*👤 사람별 리뷰 코멘트*\n```\n${comments_by_person}```"},
         },
         {
             "type": "context",
-            "elements": [{"type": "mrkdwn", "text": f"📅 {since_str} ~ {until_str}"}],
+            "elements": [{"type": "mrkdwn", "text": "📅 ${since} ~ ${until}"}],
         },
-    ]
+    ],
+}, ensure_ascii=False, separators=(",", ":")))
 
-    payload = json.dumps({
-        "channel": channel,
-        "attachments": [{"color": "#6C5CE7", "blocks": blocks}],
-    }).encode()
-
-    req = urllib.request.Request(
-        "https://slack.com/api/chat.postMessage",
-        data=payload,
-        headers={
-            "Authorization": f"Bearer {token}",
-            "Content-Type": "application/json",
-        },
-    )
 
-    with urllib.request.urlopen(req) as resp:
-        result = json.loads(resp.read())
+def _json_str(value):
+    """JSON 문자열 리터럴 안에 넣을 수 있게 이스케이프"""
+    return json.dumps(str(value), ensure_ascii=False)[1:-1]
+
+
+def send_slack(stats, since, until):
+    """Slack Bot Token으로 메시지 전송"""
+    token = os.environ["SLACK_BOT_TOKEN"]
+    channel = os.environ["SLACK_CHANNEL_ID"]
+
+    values = {
+        "channel": channel,
+        "total_prs": stats["total_prs"],
+        "total_comments": stats["total_comments"],
+        "pr_by_repo": ranking(stats["pr_by_repo"]),
+        "pr_by_person": ranking(stats["pr_by_person"]),
+        "comments_by_repo": ranking(stats["comments_by_repo"]),
+        "comments_by_person": ranking(stats["comments_by_person"]),
+        "since": since.astimezone(KST).strftime("%m/%d %H:%M"),
+        "until": until.astimezone(KST).strftime("%m/%d %H:%M"),
+    }
+    payload = SLACK_TEMPLATE.substitute({k: _json_str(v) for k, v in values.items()}).encode()
+    result = post_json(SLACK_POST_URL, payload, token, idempotent=False)
     if not result.get("ok"):
         print(f"Slack error: {result.get('error')}", file=sys.stderr)
         sys.exit(1)
@@ -254,14 +420,19 @@ def main():
     since_fmt = since.astimezone(KST).strftime("%Y-%m-%d %H:%M")
     until_fmt = until.astimezone(KST).strftime("%Y-%m-%d %H:%M")
     print(f"📊 {org} 주간 PR 리포트 ({since_fmt} ~ {until_fmt})")
-
-    created_prs = search_prs_created(org, since, until)
-    print(f"  생성된 PR: {len(created_prs)}건")
-
-    updated_prs = search_prs_with_reviews(org, since, until)
-    print(f"  리뷰 활동 PR: {len(updated_prs)}건")
-
-    stats = aggregate(created_prs, updated_prs, since, until)
+    since_iso = to_github_date(since)
+    until_iso = to_github_date(until)
+
+    stats = load_cached_stats(org, since, until)
+    if stats:
+        print("  캐시된 집계 결과 사용")
+    else:
+        created_prs, updated_prs = search_prs(org, since_iso, until_iso)
+        print(f"  생성된 PR: {len(created_prs)}건")
+        print(f"  리뷰 활동 PR: {len(updated_prs)}건")
+
+        stats = aggregate(created_prs, updated_prs, since_iso, until_iso)
+        save_cached_stats(org, since, until, stats)
     print(f"  합계: PR {stats['total_prs']}건, 리뷰 코멘트 {stats['total_comments']}건")
 
     send_slack(stats, since, until)